@@ -0,0 +1,33 @@
+# coding=utf-8
+# Copyright 2021 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# python3
+"""Pytest configuration for the uploader service tests.
+
+Replaces Cloud Logging with a mock before the test modules import main,
+mirroring what test_runner does for unittest discovery. The unit tests in
+this directory keep no cross-test shared state (every test works on its own
+mocks), so the suite can also be distributed across CPU cores with
+pytest-xdist. The service modules use flat imports, so pytest must be
+started from this directory:
+
+  cd appengine/uploader && python -m pytest -n auto main_test.py
+"""
+
+import unittest.mock
+
+import google.cloud
+
+google.cloud.logging = unittest.mock.MagicMock()
@@ -16,18 +16,24 @@
 # python3
 """Tests for App Engine server of uploader service."""
 
+import copy
 import http
 import json
+import logging
 import socket
+import types
 import unittest
 import unittest.mock as mock
 
 from google.cloud import bigquery
 from googleapiclient import errors
-from parameterized import parameterized
 
+import bigquery_client
 import constants
+import content_api_client
 import main
+import result_recorder
+import shoptimizer_client
 from models import failure
 from models import process_result
 
@@ -40,277 +46,275 @@ DUMMY_REQUEST_BODY = json.dumps({
     'batch_size': DUMMY_BATCH_SIZE,
     'timestamp': DUMMY_TIMESTAMP,
 })
+# Bodies are posted as bytes so the test client does not re-encode the same
+# string on every request.
+DUMMY_REQUEST_BODY_BYTES = DUMMY_REQUEST_BODY.encode('utf-8')
+DUMMY_ZERO_BATCH_BODY = json.dumps({
+    'start_index': DUMMY_START_INDEX,
+    'batch_size': 0,
+    'timestamp': DUMMY_TIMESTAMP,
+}).encode('utf-8')
+EXPECTED_BATCH_ID = DUMMY_START_INDEX // DUMMY_BATCH_SIZE + 1
 DUMMY_SUCCESSES = ['0001', '0002', '0003']
 DUMMY_FAILURES = [failure.Failure('0004', 'Error message')]
 DUMMY_SKIPPED = ['0005']
 INSERT_URL = '/insert_items'
 DELETE_URL = '/delete_items'
 PREVENT_EXPIRING_URL = '/prevent_expiring_items'
+_OK_HEADERS = {'X-AppEngine-TaskExecutionCount': '0'}
+# Errors used as side effects are pure data, so they are built once here
+# instead of once per test. HttpError only reads status and reason off the
+# response, so a SimpleNamespace is enough and far cheaper than a MagicMock.
+_HTTP_400 = errors.HttpError(
+    types.SimpleNamespace(
+        status=int(http.HTTPStatus.BAD_REQUEST), reason='Bad Request'), b'')
+_HTTP_500 = errors.HttpError(
+    types.SimpleNamespace(
+        status=int(http.HTTPStatus.INTERNAL_SERVER_ERROR),
+        reason='Server got itself in trouble'), b'')
+_HTTP_PAYMENT_REQUIRED = errors.HttpError(
+    types.SimpleNamespace(
+        status=int(http.HTTPStatus.PAYMENT_REQUIRED),
+        reason='Payment Required'), b'')
+_SOCKET_TIMEOUT = socket.timeout()
+# The expected fallout of _HTTP_400 failing a whole batch is derived from
+# constants, so it is computed once here rather than per test run.
+_DUMMY_BAD_REQUEST_FAILURES = [
+    failure.Failure(
+        str(item.get('item_id', 'Missing ID')), _HTTP_400.resp.reason)
+    for item in DUMMY_ROWS
+]
+_DUMMY_BAD_REQUEST_RESULT = process_result.ProcessResult(
+    [], _DUMMY_BAD_REQUEST_FAILURES, [])
+# Constants wired on the mock prototypes are shared by reference instead of
+# being duplicated (bigquery.Row does not even survive a deepcopy), so the
+# copies in setUp seed their deepcopy memo with these entries.
+_DEEPCOPY_MEMO = {
+    id(DUMMY_ROWS): DUMMY_ROWS,
+    id(DUMMY_SUCCESSES): DUMMY_SUCCESSES,
+    id(DUMMY_FAILURES): DUMMY_FAILURES,
+}
+
+# Session-scoped fixtures, built once at import time so the cost is paid per
+# test process rather than per test or per class. Autospec introspection is
+# expensive, so each test works on a cheap copy of these prototypes. The
+# shared return values are wired on the prototypes once and carried over by
+# the per-test deepcopy; wiring the chains here also guarantees the child
+# mocks exist before copying, because children created lazily after
+# copy.deepcopy would inherit the wrong spec.
+_BQ_CLIENT_PROTO = mock.create_autospec(bigquery_client.BigQueryClient)
+_BQ_CLIENT_PROTO.from_service_account_json.return_value.load_items.return_value = DUMMY_ROWS
+_CONTENT_API_CLIENT_PROTO = mock.create_autospec(
+    content_api_client.ContentApiClient)
+_CONTENT_API_CLIENT_PROTO.return_value.process_items.return_value = (
+    DUMMY_SUCCESSES, DUMMY_FAILURES)
+
+# The Flask test client is stateless across requests, so one instance is
+# shared by every test instead of being rebuilt per test.
+main.app.testing = True
+_SHARED_TEST_CLIENT = main.app.test_client()
 
 
 class MainTest(unittest.TestCase):
 
   def setUp(self):
     super(MainTest, self).setUp()
-    main.app.testing = True
-    self.test_client = main.app.test_client()
-
-    self.mock_bq_client = mock.patch(
-        'bigquery_client.BigQueryClient', autospec=True).start()
-    self.mock_content_api_client = mock.patch(
-        'content_api_client.ContentApiClient', autospec=True).start()
-    self.mock_recorder = mock.patch(
-        'result_recorder.ResultRecorder', autospec=True).start()
-    self.mock_shoptimizer_client = mock.patch(
-        'shoptimizer_client.ShoptimizerClient', autospec=True).start()
-
-    self.mock_bq_client.from_service_account_json.return_value.load_items.return_value = DUMMY_ROWS
-    self.mock_content_api_client.return_value.process_items.return_value = (
-        DUMMY_SUCCESSES, DUMMY_FAILURES)
+    self.test_client = _SHARED_TEST_CLIENT
+
+    # Each deepcopy gets its own memo copy: deepcopy records every object it
+    # clones in the memo, so reusing one dict would share mocks across tests.
+    # patch.object skips the importlib target resolution that the string
+    # form of mock.patch performs on every start().
+    self.mock_bq_client = mock.patch.object(
+        bigquery_client, 'BigQueryClient',
+        new=copy.deepcopy(_BQ_CLIENT_PROTO, dict(_DEEPCOPY_MEMO))).start()
+    self.mock_content_api_client = mock.patch.object(
+        content_api_client, 'ContentApiClient',
+        new=copy.deepcopy(_CONTENT_API_CLIENT_PROTO,
+                          dict(_DEEPCOPY_MEMO))).start()
+    # These two mocks are only inspected via assert_called*, so a plain
+    # attribute swap is enough and avoids mock.patch's start/stop machinery.
+    # spec= still validates attribute names without autospec's deep signature
+    # introspection.
+    self._orig_recorder = result_recorder.ResultRecorder
+    result_recorder.ResultRecorder = self.mock_recorder = mock.MagicMock(
+        spec=result_recorder.ResultRecorder)
+    # Cached so assertions do not re-walk the mock attribute chain.
+    self._recorder_inst = self.mock_recorder.from_service_account_json.return_value
+    self.addCleanup(setattr, result_recorder, 'ResultRecorder',
+                    self._orig_recorder)
+    self._orig_shoptimizer_client = shoptimizer_client.ShoptimizerClient
+    shoptimizer_client.ShoptimizerClient = self.mock_shoptimizer_client = (
+        mock.MagicMock(spec=shoptimizer_client.ShoptimizerClient))
+    self.addCleanup(setattr, shoptimizer_client, 'ShoptimizerClient',
+                    self._orig_shoptimizer_client)
 
     self.addCleanup(mock.patch.stopall)
 
-  @parameterized.expand(((INSERT_URL,), (DELETE_URL,)))
-  def test_run_process_should_return_ok_when_batch_size_is_positive(self, url):
-    response = self.test_client.post(
-        url,
-        data=DUMMY_REQUEST_BODY,
-        headers={'X-AppEngine-TaskExecutionCount': '0'})
+  def _post(self, url, body=DUMMY_REQUEST_BODY_BYTES, headers=_OK_HEADERS):
+    """Posts a task request to the given URL and returns the response."""
+    return self.test_client.post(
+        url, data=body, headers=headers, content_type='application/json')
 
-    self.assertEqual(http.HTTPStatus.OK, response.status_code)
+  def test_run_process_should_return_ok_when_batch_size_is_positive(self):
+    for url in (INSERT_URL, DELETE_URL):
+      with self.subTest(url=url):
+        response = self._post(url)
 
-  def test_run_process_should_do_nothing_when_batch_size_is_zero(self):
-    request_body = json.dumps({
-        'start_index': DUMMY_START_INDEX,
-        'batch_size': 0,
-        'timestamp': DUMMY_TIMESTAMP,
-    })
+        self.assertEqual(http.HTTPStatus.OK, response.status_code)
 
-    response = self.test_client.post(
-        INSERT_URL,
-        data=request_body,
-        headers={'X-AppEngine-TaskExecutionCount': '0'})
+  def test_run_process_should_do_nothing_when_batch_size_is_zero(self):
+    response = self._post(INSERT_URL, body=DUMMY_ZERO_BATCH_BODY)
 
     self.mock_bq_client.from_service_account_json.return_value.load_items.assert_not_called(
     )
     self.mock_content_api_client.return_value.process_items.assert_not_called()
-    self.mock_recorder.from_service_account_json.return_value.insert_result.assert_not_called(
-    )
+    self._recorder_inst.insert_result.assert_not_called()
     self.assertEqual(http.HTTPStatus.OK, response.status_code)
 
   def test_run_process_should_load_items_from_biqquery(self):
-    self.test_client.post(
-        INSERT_URL,
-        data=DUMMY_REQUEST_BODY,
-        headers={'X-AppEngine-TaskExecutionCount': '0'})
+    self._post(INSERT_URL)
 
     self.mock_bq_client.from_service_account_json.return_value.load_items.assert_called_once(
     )
 
   def test_run_process_should_return_error_when_failing_to_load_items_from_bigquery(
       self):
-    self.mock_bq_client.from_service_account_json.return_value.load_items.side_effect = errors.HttpError(
-        mock.MagicMock(), b'')
+    self.mock_bq_client.from_service_account_json.return_value.load_items.side_effect = _HTTP_500
 
-    response = self.test_client.post(
-        INSERT_URL,
-        data=DUMMY_REQUEST_BODY,
-        headers={'X-AppEngine-TaskExecutionCount': '0'})
+    response = self._post(INSERT_URL)
 
     self.assertEqual(http.HTTPStatus.INTERNAL_SERVER_ERROR,
                      response.status_code)
 
   def test_run_process_should_call_content_api(self):
-    self.test_client.post(
-        INSERT_URL,
-        data=DUMMY_REQUEST_BODY,
-        headers={'X-AppEngine-TaskExecutionCount': '0'})
+    self._post(INSERT_URL)
 
     self.mock_content_api_client.return_value.process_items.assert_called_once()
 
-  def test_run_process_should_call_content_api_with_insert_when_operation_is_insert(
+  def test_run_process_should_call_content_api_with_method_matching_operation(
       self):
-    self.test_client.post(
-        INSERT_URL,
-        data=DUMMY_REQUEST_BODY,
-        headers={'X-AppEngine-TaskExecutionCount': '0'})
+    cases = ((INSERT_URL, constants.Method.INSERT),
+             (PREVENT_EXPIRING_URL, constants.Method.INSERT),
+             (DELETE_URL, constants.Method.DELETE))
+    process_items = self.mock_content_api_client.return_value.process_items
+    for url, expected_method in cases:
+      with self.subTest(url=url):
+        process_items.reset_mock()
+        self._post(url)
 
-    self.mock_content_api_client.return_value.process_items.assert_any_call(
-        mock.ANY, mock.ANY, mock.ANY, constants.Method.INSERT)
+        self.assertEqual(expected_method, process_items.call_args.args[3])
 
-  def test_run_process_should_call_content_api_with_insert_when_operation_is_prevent_expiring(
-      self):
-    self.test_client.post(
-        PREVENT_EXPIRING_URL,
-        data=DUMMY_REQUEST_BODY,
-        headers={'X-AppEngine-TaskExecutionCount': '0'})
-
-    self.mock_content_api_client.return_value.process_items.assert_any_call(
-        mock.ANY, mock.ANY, mock.ANY, constants.Method.INSERT)
-
-  def test_run_process_should_call_content_api_with_delete_when_operation_is_delete(
+  def test_run_process_should_return_the_same_error_when_content_api_call_returns_error_and_retry_is_suggested(
       self):
-    self.test_client.post(
-        DELETE_URL,
-        data=DUMMY_REQUEST_BODY,
-        headers={'X-AppEngine-TaskExecutionCount': '0'})
+    for reason, status in (
+        ('BAD REQUEST', http.HTTPStatus.BAD_REQUEST),
+        ('INTERNAL SERVER ERROR', http.HTTPStatus.INTERNAL_SERVER_ERROR)):
+      with self.subTest(reason=reason), mock.patch.object(
+          content_api_client, 'suggest_retry') as suggest_retry:
+        suggest_retry.return_value = True
+        self.mock_content_api_client.return_value.process_items.side_effect = errors.HttpError(
+            types.SimpleNamespace(status=int(status), reason=reason), b'')
 
-    self.mock_content_api_client.return_value.process_items.assert_any_call(
-        mock.ANY, mock.ANY, mock.ANY, constants.Method.DELETE)
+        response = self._post(INSERT_URL)
 
-  @parameterized.expand(
-      (('BAD REQUEST', http.HTTPStatus.BAD_REQUEST),
-       ('INTERNAL SERVER ERROR', http.HTTPStatus.INTERNAL_SERVER_ERROR)))
-  def test_run_process_should_return_the_same_error_when_content_api_call_returns_error_and_retry_is_suggested(
-      self, reason, status):
-    with mock.patch('content_api_client.suggest_retry') as suggest_retry:
-      suggest_retry.return_value = True
-      self.mock_content_api_client.return_value.process_items.side_effect = errors.HttpError(
-          mock.MagicMock(status=status, reason=reason), b'')
-
-      response = self.test_client.post(
-          INSERT_URL,
-          data=DUMMY_REQUEST_BODY,
-          headers={'X-AppEngine-TaskExecutionCount': '0'})
-
-      self.assertEqual(status, response.status_code)
-      self.assertEqual(reason, response.data.decode())
+        self.assertEqual(status, response.status_code)
+        self.assertEqual(reason, response.data.decode())
 
   def test_run_process_should_return_error_when_content_api_call_returns_error_and_retry_is_not_suggested(
       self):
-    with mock.patch('content_api_client.suggest_retry') as suggest_retry:
+    with mock.patch.object(
+        content_api_client, 'suggest_retry') as suggest_retry:
       suggest_retry.return_value = False
-      self.mock_content_api_client.return_value.process_items.side_effect = errors.HttpError(
-          mock.MagicMock(
-              status=http.HTTPStatus.PAYMENT_REQUIRED,
-              reason='Payment Required'), b'')
+      self.mock_content_api_client.return_value.process_items.side_effect = _HTTP_PAYMENT_REQUIRED
 
-      response = self.test_client.post(
-          INSERT_URL,
-          data=DUMMY_REQUEST_BODY,
-          headers={'X-AppEngine-TaskExecutionCount': '0'})
+      response = self._post(INSERT_URL)
 
       self.assertEqual(http.HTTPStatus.PAYMENT_REQUIRED, response.status_code)
 
   def test_run_process_should_return_timeout_error_when_content_api_call_returns_socket_timeout_error(
       self):
-    self.mock_content_api_client.return_value.process_items.side_effect = socket.timeout(
-    )
+    self.mock_content_api_client.return_value.process_items.side_effect = _SOCKET_TIMEOUT
 
-    response = self.test_client.post(
-        INSERT_URL,
-        data=DUMMY_REQUEST_BODY,
-        headers={'X-AppEngine-TaskExecutionCount': '0'})
+    response = self._post(INSERT_URL)
 
     self.assertEqual(http.HTTPStatus.REQUEST_TIMEOUT, response.status_code)
 
   def test_run_process_should_log_error_when_max_retry_attempts_exhausted(self):
     max_retry_count = 5
-    http_error = errors.HttpError(
-        mock.MagicMock(
-            status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
-            reason='Server got itself in trouble'), b'')
-    self.mock_content_api_client.return_value.process_items.side_effect = http_error
-
-    with self.assertLogs(level='ERROR') as log:
-      self.test_client.post(
+    self.mock_content_api_client.return_value.process_items.side_effect = _HTTP_500
+
+    # Patching logging.error is cheaper than assertLogs, which installs a
+    # capturing handler and formats every record.
+    with mock.patch.object(logging, 'error') as mock_error:
+      self._post(
           INSERT_URL,
-          data=DUMMY_REQUEST_BODY,
           headers={'X-AppEngine-TaskExecutionCount': f'{max_retry_count}'})
 
-      self.assertIn(
-          f'ERROR:root:Batch #1 with operation upsert and initiation timestamp {DUMMY_TIMESTAMP} '
-          f'failed and will not be retried. '
-          f'Error: {http_error}', log.output)
+    mock_error.assert_called_once()
+    logged_message = mock_error.call_args.args[0] % mock_error.call_args.args[1:]
+    self.assertEqual(
+        f'Batch #1 with operation upsert and initiation timestamp '
+        f'{DUMMY_TIMESTAMP} failed and will not be retried. Error: {_HTTP_500}',
+        logged_message)
 
   def test_run_process_should_return_ok_when_execution_count_header_missing_and_content_api_call_returns_success(
       self):
-    self.mock_bq_client.from_service_account_json.return_value.load_items.return_value = DUMMY_ROWS
-    response = self.test_client.post(INSERT_URL, data=DUMMY_REQUEST_BODY)
+    response = self._post(INSERT_URL, headers=None)
     self.assertEqual(http.HTTPStatus.OK, response.status_code)
 
   def test_run_process_should_log_error_when_execution_count_header_missing_and_content_api_call_returns_error(
       self):
-    http_error = errors.HttpError(
-        mock.MagicMock(
-            status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
-            reason='Server got itself in trouble'), b'')
-    self.mock_content_api_client.return_value.process_items.side_effect = http_error
+    self.mock_content_api_client.return_value.process_items.side_effect = _HTTP_500
 
-    with self.assertLogs(level='ERROR') as log:
-      self.test_client.post(INSERT_URL, data=DUMMY_REQUEST_BODY)
+    with mock.patch.object(logging, 'error') as mock_error:
+      self._post(INSERT_URL, headers=None)
 
-      self.assertIn(
-          f'ERROR:root:Batch #1 with operation upsert and initiation timestamp {DUMMY_TIMESTAMP} '
-          f'failed and will not be retried. '
-          f'Error: {http_error}', log.output)
+    mock_error.assert_called_once()
+    logged_message = mock_error.call_args.args[0] % mock_error.call_args.args[1:]
+    self.assertEqual(
+        f'Batch #1 with operation upsert and initiation timestamp '
+        f'{DUMMY_TIMESTAMP} failed and will not be retried. Error: {_HTTP_500}',
+        logged_message)
 
   def test_run_process_should_record_result_when_content_api_call_returns_ok(
       self):
-    expected_batch_id = int(DUMMY_START_INDEX / DUMMY_BATCH_SIZE) + 1
     expected_result = process_result.ProcessResult(DUMMY_SUCCESSES,
                                                    DUMMY_FAILURES, [])
 
-    self.test_client.post(
-        INSERT_URL,
-        data=DUMMY_REQUEST_BODY,
-        headers={'X-AppEngine-TaskExecutionCount': '0'})
+    self._post(INSERT_URL)
 
-    self.mock_recorder.from_service_account_json.return_value.insert_result.assert_called_once_with(
+    self._recorder_inst.insert_result.assert_called_once_with(
         constants.Operation.UPSERT.value,
         expected_result,
         DUMMY_TIMESTAMP,
-        expected_batch_id,
+        EXPECTED_BATCH_ID,
     )
 
   def test_run_process_should_record_that_all_items_failed_when_content_api_call_returns_error(
       self):
-    dummy_http_error = errors.HttpError(
-        mock.MagicMock(
-            status=http.HTTPStatus.BAD_REQUEST, reason='Bad Request'), b'')
-    self.mock_content_api_client.return_value.process_items.side_effect = dummy_http_error
-    dummy_failures = [
-        failure.Failure(
-            str(item.get('item_id', 'Missing ID')),
-            dummy_http_error.resp.reason) for item in DUMMY_ROWS
-    ]
-    expected_result = process_result.ProcessResult([], dummy_failures, [])
-    expected_batch_id = int(DUMMY_START_INDEX / DUMMY_BATCH_SIZE) + 1
-    self.mock_bq_client.from_service_account_json.return_value.load_items.return_value = DUMMY_ROWS
-
-    self.test_client.post(
-        INSERT_URL,
-        data=DUMMY_REQUEST_BODY,
-        headers={'X-AppEngine-TaskExecutionCount': '0'})
-
-    self.mock_recorder.from_service_account_json.return_value.insert_result.assert_called_once_with(
+    self.mock_content_api_client.return_value.process_items.side_effect = _HTTP_400
+
+    self._post(INSERT_URL)
+
+    self._recorder_inst.insert_result.assert_called_once_with(
         constants.Operation.UPSERT.value,
-        expected_result,
+        _DUMMY_BAD_REQUEST_RESULT,
         DUMMY_TIMESTAMP,
-        expected_batch_id,
+        EXPECTED_BATCH_ID,
     )
 
-  def test_run_process_should_call_shoptimizer_when_operation_is_insert(self):
-    self.test_client.post(
-        INSERT_URL,
-        data=DUMMY_REQUEST_BODY,
-        headers={'X-AppEngine-TaskExecutionCount': '0'})
-
-    self.mock_shoptimizer_client.return_value.shoptimize.assert_called_once()
-
-  def test_run_process_should_call_shoptimizer_when_operation_is_prevent_expiring(
+  def test_run_process_should_call_shoptimizer_only_when_operation_optimizable(
       self):
-    self.test_client.post(
-        PREVENT_EXPIRING_URL,
-        data=DUMMY_REQUEST_BODY,
-        headers={'X-AppEngine-TaskExecutionCount': '0'})
-
-    self.mock_shoptimizer_client.return_value.shoptimize.assert_called_once()
-
-  def test_run_process_should_call_shoptimizer_when_operation_is_delete(self):
-    self.test_client.post(
-        DELETE_URL,
-        data=DUMMY_REQUEST_BODY,
-        headers={'X-AppEngine-TaskExecutionCount': '0'})
-
-    self.mock_shoptimizer_client.return_value.shoptimize.assert_not_called()
+    shoptimize = self.mock_shoptimizer_client.return_value.shoptimize
+    for url, expect_shoptimize in ((INSERT_URL, True),
+                                   (PREVENT_EXPIRING_URL, True),
+                                   (DELETE_URL, False)):
+      with self.subTest(url=url):
+        shoptimize.reset_mock()
+        self._post(url)
+
+        if expect_shoptimize:
+          shoptimize.assert_called_once()
+        else:
+          shoptimize.assert_not_called()